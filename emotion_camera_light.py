@@ -8,14 +8,26 @@
   摄像头捕获 -> DeepFace情绪识别 -> 情绪映射 -> 蓝牙控制台灯
 """
 
+import os
 import sys
 import time
 import logging
+import collections
+import queue
+import threading
+
+# TF和OpenCV各自按核数开线程池，树莓派上叠一起互相抢核，必须在import前限住
+os.environ.setdefault('OMP_NUM_THREADS', '2')
+os.environ.setdefault('TF_NUM_INTRAOP_THREADS', '2')
+os.environ.setdefault('TF_NUM_INTEROP_THREADS', '1')
+
 import cv2
 import numpy as np
 from bluepy import btle
 from deepface import DeepFace
 
+cv2.setNumThreads(1)
+
 # ============ 第一部分：配置参数 ============
 # 设置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s: %(message)s')
@@ -25,6 +37,7 @@ logger = logging.getLogger(__name__)
 CAMERA_WIDTH = 640      # 图像宽度，降低分辨率以提高处理速度
 CAMERA_HEIGHT = 480     # 图像高度
 FRAME_SKIP = 5          # 每5帧处理一次，减少计算负担
+EMOTION_STABLE_FRAMES = 3  # 新情绪连续出现这么多帧才切灯，防止分类抖动刷蓝牙
 
 # 蓝牙设备配置（必须修改！）
 DEVICE_MAC = "AA:BB:CC:DD:EE:FF"  # 替换为您的台灯蓝牙MAC地址
@@ -40,7 +53,12 @@ class BluetoothLampController:
         self.device = None
         self.control_char = None
         self._connect()
-    
+
+        # 蓝牙写一次要几十毫秒，指令丢进队列由后台线程发，视频循环不等它
+        self._q = queue.Queue(maxsize=4)
+        self._worker = threading.Thread(target=self._drain, daemon=True)
+        self._worker.start()
+
     def _connect(self):
         """建立蓝牙连接"""
         try:
@@ -59,31 +77,52 @@ class BluetoothLampController:
     def set_light(self, brightness=50, rgb=(255, 255, 255)):
         """
         设置灯光参数
-        
+
         参数：
           brightness: 亮度 (0-100)
           rgb: 颜色元组 (R, G, B)
         """
+        # 构建控制指令（需要根据实际协议调整）
+        # 示例格式：[起始符, 亮度, R, G, B]
+        self._enqueue(bytes([0xAA, brightness, rgb[0], rgb[1], rgb[2]]))
+        logger.debug(f"灯光设置: 亮度{brightness}%, RGB{rgb}")
+
+    def write_payload(self, payload):
+        """发送预打包好的控制指令（热路径，不再逐字节构建）"""
+        self._enqueue(payload)
+
+    def _enqueue(self, payload):
+        """只关心最新的灯光状态，队列满了就挤掉最旧的"""
         try:
-            # 构建控制指令（需要根据实际协议调整）
-            # 示例格式：[起始符, 亮度, R, G, B]
-            cmd = bytearray([0xAA])  # 假设起始符
-            cmd.append(brightness)   # 亮度
-            cmd.append(rgb[0])       # 红色
-            cmd.append(rgb[1])       # 绿色
-            cmd.append(rgb[2])       # 蓝色
-            
-            # 发送指令
-            self.control_char.write(cmd)
-            logger.debug(f"灯光设置: 亮度{brightness}%, RGB{rgb}")
-            
-        except Exception as e:
-            logger.error(f"控制指令失败: {e}")
-            # 尝试重新连接
+            self._q.put_nowait(payload)
+        except queue.Full:
+            try:
+                self._q.get_nowait()
+            except queue.Empty:
+                pass
+            self._q.put_nowait(payload)
+
+    def _drain(self):
+        """后台线程：逐条取指令做真正的蓝牙写，失败时重连"""
+        while True:
+            payload = self._q.get()
             try:
-                self._connect()
-            except:
-                logger.error("重新连接失败")
+                self.control_char.write(payload)
+            except Exception as e:
+                logger.error(f"控制指令失败: {e}")
+                # 尝试重新连接
+                try:
+                    self._connect()
+                except:
+                    logger.error("重新连接失败")
+            finally:
+                self._q.task_done()
+
+    def close(self, timeout=2.0):
+        """等队列里的指令发完再返回；退出前的最后一条柔和灯光不能被daemon线程吞掉"""
+        deadline = time.monotonic() + timeout
+        while self._q.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.05)
 
 # ============ 第三部分：情绪识别与映射 ============
 
@@ -91,10 +130,18 @@ class EmotionProcessor:
     """情绪处理器：识别情绪并映射到灯光参数"""
     
     def __init__(self):
-        # DeepFace支持的7种基本情绪
-        self.supported_emotions = ['angry', 'disgust', 'fear', 'happy', 
+        # DeepFace支持的7种基本情绪（顺序和表情模型的输出一致）
+        self.supported_emotions = ['angry', 'disgust', 'fear', 'happy',
                                    'sad', 'surprise', 'neutral']
-        
+
+        # 表情模型只在这里构建一次；analyze包装每次调用都要重建元数据，太贵
+        self.emotion_model = DeepFace.build_model("Emotion")
+
+        # 画面指纹缓存：人坐着不动时帧与帧几乎一样，没变化就复用上次结果
+        self._sig_diff_skip = 2304  # 约16x16x3缩略图，平均每通道差3以内算同一画面
+        self._last_sig = None
+        self._last_dominant = None
+
         # 情绪到灯光参数的映射（基于您的要求）
         self.emotion_to_light = {
             # DeepFace原生情绪 -> (亮度, RGB颜色)
@@ -110,88 +157,128 @@ class EmotionProcessor:
         }
         
         # 专注和疲惫状态检测（基于连续帧分析）
-        self.emotion_history = []  # 存储最近的情绪历史
         self.history_max_len = 20  # 历史记录最大长度
+        # deque两头进出都是O(1)；计数随窗口进出增减，不再每帧全扫
+        self.emotion_history = collections.deque(maxlen=self.history_max_len)
+        self._recent_counts = collections.Counter()
+
+        # 每种情绪的5字节控制指令在这里一次性打包好，热循环里直接取现成的
+        self._light_payloads = {}
+        for name, (brightness, rgb) in {**self.emotion_to_light,
+                                        'focused': (95, (255, 255, 255)),
+                                        'tired':   (45, (255, 180, 80))}.items():
+            self._light_payloads[name] = bytes([0xAA, brightness, *rgb])
+
+    def light_payload(self, emotion):
+        """取情绪对应的预打包控制指令"""
+        return self._light_payloads.get(emotion, self._light_payloads['default'])
+
+    def is_stable(self, emotion, k):
+        """最近k帧是否都是同一情绪（focused/tired由窗口统计产生，本身已稳定）"""
+        if len(self.emotion_history) < k:
+            return False
+        it = reversed(self.emotion_history)
+        return all(next(it) == emotion for _ in range(k))
     
     def detect_emotion(self, frame):
         """
-        使用DeepFace检测图像中的情绪
-        
+        检测图像中的情绪（直接调用构造时建好的表情模型，不经过analyze包装）
+
         参数:
           frame: 摄像头捕获的图像帧
-          
+
         返回:
           情绪字符串 (如 'happy', 'sad', 'neutral' 等)
         """
+        # 粗采样出约16x16的缩略图当指纹（纯numpy，传进来的反向视图也能处理）
+        sig = frame[::max(1, frame.shape[0] // 16),
+                    ::max(1, frame.shape[1] // 16)].astype('int16')
+        if (self._last_sig is not None and sig.shape == self._last_sig.shape
+                and int(np.abs(sig - self._last_sig).sum()) < self._sig_diff_skip):
+            # 画面没变：检测和推理都跳过，但历史照常推进，专注/疲惫统计不中断
+            if self._last_dominant is None:
+                return 'neutral'
+            self._update_emotion_history(self._last_dominant)
+            return self._analyze_emotion_pattern() or self._last_dominant
+        self._last_sig = sig
+        self._last_dominant = None
+
         try:
-            # 使用DeepFace分析情绪
+            # 只让DeepFace做人脸检测和裁剪
             # enforce_detection=False 允许在没有检测到人脸时继续运行
-            analysis = DeepFace.analyze(
-                frame, 
-                actions=['emotion'],
+            faces = DeepFace.extract_faces(
+                frame,
+                detector_backend='opencv',
                 enforce_detection=False,
-                silent=True  # 减少输出
             )
-            
-            # 提取主要情绪
-            if isinstance(analysis, list) and len(analysis) > 0:
-                emotion_result = analysis[0]
-                dominant_emotion = emotion_result.get('dominant_emotion', 'neutral')
-                
-                # 获取情绪置信度
-                emotion_scores = emotion_result.get('emotion', {})
-                confidence = emotion_scores.get(dominant_emotion, 0)
-                
+
+            if faces:
+                # 取置信度最高的那张脸
+                face = max(faces, key=lambda f: f.get('confidence', 0))
+                # extract_faces返回0-1浮点图；表情模型要48x48灰度输入
+                face_img = (face['face'] * 255).astype('uint8')
+                gray = cv2.resize(cv2.cvtColor(face_img, cv2.COLOR_BGR2GRAY), (48, 48))
+                scores = np.asarray(self.emotion_model.predict(np.expand_dims(gray, 0))).reshape(-1)
+
+                idx = int(scores.argmax())
+                dominant_emotion = self.supported_emotions[idx]
+                total = float(scores.sum())
+                confidence = float(scores[idx]) * 100.0 / total if total else 0.0
+
                 # 只接受置信度高于阈值的识别结果
                 if confidence > 20:  # 置信度阈值20%
                     logger.debug(f"检测到情绪: {dominant_emotion} (置信度: {confidence:.1f}%)")
-                    
+
+                    # 记下这次的主导情绪，画面不变时直接复用
+                    self._last_dominant = dominant_emotion
+
                     # 更新情绪历史
                     self._update_emotion_history(dominant_emotion)
-                    
+
                     # 分析连续情绪状态（检测专注/疲惫）
                     special_state = self._analyze_emotion_pattern()
                     if special_state:
                         return special_state
-                    
+
                     return dominant_emotion
-            
+
             return 'neutral'
-            
+
         except Exception as e:
             logger.error(f"情绪识别失败: {e}")
             return 'neutral'
     
     def _update_emotion_history(self, emotion):
-        """更新情绪历史记录"""
+        """更新情绪历史记录（同时维护计数）"""
+        if len(self.emotion_history) == self.history_max_len:
+            old = self.emotion_history[0]
+            self._recent_counts[old] -= 1
+            if not self._recent_counts[old]:
+                del self._recent_counts[old]
         self.emotion_history.append(emotion)
-        if len(self.emotion_history) > self.history_max_len:
-            self.emotion_history.pop(0)
-    
+        self._recent_counts[emotion] += 1
+
     def _analyze_emotion_pattern(self):
         """
         分析情绪历史，检测特殊状态
-        
+
         返回:
           'focused': 专注状态（连续多帧中性/平静）
           'tired': 疲惫状态（连续多帧低落/变化缓慢）
         """
-        if len(self.emotion_history) < 10:
+        window = len(self.emotion_history)
+        if window < 10:
             return None
-        
-        # 检查是否专注（最近10帧中有8帧以上是中性/平静）
-        recent = self.emotion_history[-10:]
-        neutral_count = recent.count('neutral')
-        calm_count = recent.count('happy')  # 将开心也视为平静状态
-        
-        if neutral_count + calm_count >= 8:
+
+        # 检查是否专注（窗口内8成以上是中性/平静，开心也视为平静状态）
+        calm_count = self._recent_counts['neutral'] + self._recent_counts['happy']
+        if calm_count >= 0.8 * window:
             return 'focused'
-        
+
         # 检查是否疲惫（情绪变化缓慢，多为低落）
-        sad_count = recent.count('sad')
-        if sad_count >= 6:
+        if self._recent_counts['sad'] >= 0.6 * window:
             return 'tired'
-        
+
         return None
     
     def map_emotion_to_light(self, emotion):
@@ -244,7 +331,7 @@ def main():
     frame_count = 0
     last_emotion = None
     last_light_params = None
-    last_emotion_time = time.time()
+    frame_ts = collections.deque(maxlen=30)  # 最近30帧时间戳，FPS=帧数/首尾时间差
     
     logger.info("✅ 系统初始化完成，开始情绪感应...")
     
@@ -261,72 +348,72 @@ def main():
             # 2. 定期进行情绪识别（跳过一些帧以提高性能）
             current_emotion = None
             if frame_count % FRAME_SKIP == 0:
-                # 转换颜色空间（DeepFace需要RGB）
-                rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                
-                # 识别情绪
-                current_emotion = emotion_processor.detect_emotion(rgb_frame)
+                # 表情分类只要48x48的脸，半分辨率足够，检测工作量和搬运量省一大半
+                small = cv2.resize(frame, (CAMERA_WIDTH // 2, CAMERA_HEIGHT // 2),
+                                   interpolation=cv2.INTER_AREA)
+                # DeepFace需要RGB：用反向切片的零拷贝视图，不再整帧cvtColor多搬一份内存
+                current_emotion = emotion_processor.detect_emotion(small[:, :, ::-1])
                 
-                # 3. 如果检测到新情绪，控制台灯
-                if current_emotion and current_emotion != last_emotion:
+                # 3. 新情绪连续几帧稳定才动灯，分类抖一下不至于反复下发蓝牙指令
+                if (current_emotion and current_emotion != last_emotion
+                        and (current_emotion in ('focused', 'tired')
+                             or emotion_processor.is_stable(current_emotion, EMOTION_STABLE_FRAMES))):
                     # 情绪映射到灯光参数
                     brightness, color = emotion_processor.map_emotion_to_light(current_emotion)
-                    
-                    # 控制台灯
-                    lamp_controller.set_light(brightness=brightness, rgb=color)
-                    
+
+                    # 参数和上次一样就不重发（不同情绪可能映射到同样的灯光）
+                    if (brightness, color) != last_light_params:
+                        # 控制台灯（指令在启动时已打包好）
+                        lamp_controller.write_payload(emotion_processor.light_payload(current_emotion))
+                        logger.info(f"情绪变化: {current_emotion} -> 亮度{brightness}%")
+
                     # 更新状态
                     last_emotion = current_emotion
                     last_light_params = (brightness, color)
-                    last_emotion_time = time.time()
-                    
-                    logger.info(f"情绪变化: {current_emotion} -> 亮度{brightness}%")
-            
-            # 4. 在画面上显示信息
-            display_frame = frame.copy()
             
+            # 4. 在画面上显示信息（直接画在frame上，干净副本没有别处用，省掉每帧900KB拷贝）
             # 显示当前情绪
             if last_emotion:
                 emotion_text = f"Emotion: {last_emotion}"
-                cv2.putText(display_frame, emotion_text, (20, 40),
+                cv2.putText(frame, emotion_text, (20, 40),
                            cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
-            
+
             # 显示灯光状态
             if last_light_params:
                 brightness, color = last_light_params
                 light_text = f"Light: {brightness}%"
-                cv2.putText(display_frame, light_text, (20, 80),
+                cv2.putText(frame, light_text, (20, 80),
                            cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255, 255, 0), 2)
-                
-                # 显示颜色预览
-                color_preview = np.zeros((30, 30, 3), dtype=np.uint8)
-                color_preview[:, :] = color
-                display_frame[20:50, CAMERA_WIDTH-50:CAMERA_WIDTH-20] = color_preview
-                cv2.rectangle(display_frame, 
-                             (CAMERA_WIDTH-50, 20), 
-                             (CAMERA_WIDTH-20, 50), 
+
+                # 显示颜色预览：一个填充矩形就够，不用再建小数组blit
+                cv2.rectangle(frame,
+                             (CAMERA_WIDTH-50, 20),
+                             (CAMERA_WIDTH-20, 50),
+                             color, -1)
+                cv2.rectangle(frame,
+                             (CAMERA_WIDTH-50, 20),
+                             (CAMERA_WIDTH-20, 50),
                              (255, 255, 255), 2)
-            
-            # 显示帧率
-            fps_text = f"FPS: {int(frame_count / (time.time() - last_emotion_time + 0.001))}"
-            cv2.putText(display_frame, fps_text, (CAMERA_WIDTH-150, 40),
-                       cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 200, 255), 2)
-            
+
+            # 显示帧率（原来的 frame_count/距上次情绪变化 算出来的不是帧率）
+            frame_ts.append(time.monotonic())
+            if len(frame_ts) > 1:
+                fps = (len(frame_ts) - 1) / (frame_ts[-1] - frame_ts[0])
+                cv2.putText(frame, f"FPS: {fps:.0f}", (CAMERA_WIDTH-150, 40),
+                           cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 200, 255), 2)
+
             # 显示提示
-            cv2.putText(display_frame, "Press 'q' to quit", (20, CAMERA_HEIGHT-20),
+            cv2.putText(frame, "Press 'q' to quit", (20, CAMERA_HEIGHT-20),
                        cv2.FONT_HERSHEY_SIMPLEX, 0.6, (150, 150, 150), 1)
-            
+
             # 5. 显示画面
-            cv2.imshow('Emotion Sensing Light', display_frame)
+            cv2.imshow('Emotion Sensing Light', frame)
             
-            # 6. 检查退出键
+            # 6. 检查退出键（waitKey(1)本身会让出CPU，不用再额外sleep）
             if cv2.waitKey(1) & 0xFF == ord('q'):
                 logger.info("收到退出信号")
                 break
-            
-            # 7. 性能调节：控制帧率
-            time.sleep(0.01)  # 小延迟，避免过度占用CPU
-            
+
     except KeyboardInterrupt:
         logger.info("程序被用户中断")
     except Exception as e:
@@ -335,9 +422,10 @@ def main():
         # 清理资源
         logger.info("正在清理资源...")
         
-        # 设置柔和灯光
+        # 设置柔和灯光（并等待指令真正发出去，进程马上就要退出了）
         lamp_controller.set_light(brightness=30, rgb=(255, 255, 200))
-        
+        lamp_controller.close()
+
         # 释放摄像头
         cap.release()
         cv2.destroyAllWindows()
@@ -365,38 +453,3 @@ if __name__ == "__main__":
     print("=" * 50)
     
     main()
-
-
-
-# 更新系统
-sudo apt-get update && sudo apt-get upgrade
-
-# 安装OpenCV
-sudo apt-get install python3-opencv
-
-# 安装DeepFace（可能需要较长时间）
-pip install deepface
-
-# 安装蓝牙库
-sudo apt-get install bluez
-pip install bluepy
-
-
-
-sudo raspi-config
-# 选择 Interface Options -> Camera -> Enable
-
-
-
-# 扫描蓝牙设备
-sudo hcitool lescan
-# 找到您的台灯并记录MAC地址
-
-# 查找服务UUID（可能需要蓝牙调试工具）
-
-
-
-python3 emotion_camera_light.py
-
-
-
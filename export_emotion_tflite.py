@@ -0,0 +1,24 @@
+import os
+
+# 把 fer 的表情模型做动态范围量化(权重 int8), 导出成 TFLite
+# 跑一次生成 emotion_int8.tflite, main.py 看到这个文件会自动改用 TFLite 推理
+
+os.environ.setdefault('TF_CPP_MIN_LOG_LEVEL', '2')
+
+import tensorflow as tf
+from fer.fer import FER
+
+OUT_PATH = 'emotion_int8.tflite'
+
+# use_tflite=False: 默认的 TFLite 分支不会创建 Keras 模型, 拿不到可转换的对象
+detector = FER(mtcnn=False, use_tflite=False)
+model = detector._FER__emotion_classifier
+
+converter = tf.lite.TFLiteConverter.from_keras_model(model)
+converter.optimizations = [tf.lite.Optimize.DEFAULT]
+tflite_model = converter.convert()
+
+with open(OUT_PATH, 'wb') as f:
+    f.write(tflite_model)
+
+print(f"Saved {OUT_PATH} ({len(tflite_model)} bytes)")
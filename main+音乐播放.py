@@ -1,11 +1,26 @@
+import collections
+import os
+import queue
+import threading
+import time
+
+# TF 和 OpenCV 各自按核数开线程池, 叠一起互相抢核, 在 import 前就限住
+os.environ.setdefault('OMP_NUM_THREADS', '2')
+os.environ.setdefault('TF_NUM_INTRAOP_THREADS', '2')
+os.environ.setdefault('TF_NUM_INTEROP_THREADS', '1')
+
 import cv2
+import numpy as np
 from fer.fer import FER
 import pygame  # ← 新增：播放器
 
+cv2.setNumThreads(1)
+
 # ==============================
 # 初始化 FER
 # ==============================
-emotion_detector = FER()
+# mtcnn 在 CPU 上太慢, 明确用 OpenCV 级联检测, 摄像头画面够用了
+emotion_detector = FER(mtcnn=False)
 
 # ==============================
 # 初始化音乐播放器
@@ -22,76 +37,130 @@ emotion_music = {
     "disgust": "music/disgust.mp3"
 }
 
+# 只有 7 首歌, 启动时一次性解码进内存, 切歌就不用再读盘卡住画面
+emotion_sounds = {}
+for _emotion, _file in emotion_music.items():
+    try:
+        emotion_sounds[_emotion] = pygame.mixer.Sound(_file)
+    except Exception as e:
+        print(f"⚠️ Cannot load {_file}: {e}")
+
+music_channel = pygame.mixer.Channel(0)
 current_music = None
 
 def play_music_for_emotion(emotion):
     global current_music
 
-    if emotion not in emotion_music:
+    if emotion not in emotion_sounds:
         return
 
-    music_file = emotion_music[emotion]
-
     # 情绪没变化，不切歌
-    if current_music == music_file:
+    if current_music == emotion:
         return
 
+    music_channel.stop()
+    music_channel.play(emotion_sounds[emotion], loops=-1)  # 循环播放
+    current_music = emotion
+    print(f"[INFO] Now playing: {emotion_music[emotion]}")
+
+
+# 切歌放到单独线程, 视频循环只往队列里丢情绪, 不等播放器
+music_q = queue.Queue(maxsize=4)
+
+def music_worker():
+    while True:
+        emotion = music_q.get()
+        # 播放出错不能带崩线程, 不然以后再也切不了歌
+        try:
+            play_music_for_emotion(emotion)
+        except Exception as e:
+            print(f"⚠️ Cannot play music for {emotion}: {e}")
+
+threading.Thread(target=music_worker, daemon=True).start()
+
+def request_music(emotion):
     try:
-        pygame.mixer.music.load(music_file)
-        pygame.mixer.music.play(-1)  # 循环播放
-        current_music = music_file
-        print(f"[INFO] Now playing: {music_file}")
-    except Exception as e:
-        print(f"⚠️ Cannot play {music_file}: {e}")
+        music_q.put_nowait(emotion)
+    except queue.Full:
+        # 只关心最新的情绪, 队列满了就把最旧的挤掉
+        try:
+            music_q.get_nowait()
+        except queue.Empty:
+            pass
+        music_q.put_nowait(emotion)
 
 
 # ==============================
 # 摄像头部分（你们原来的完全保留）
 # ==============================
-cap = cv2.VideoCapture(0);
+# 明确走 V4L2 并要 MJPG: 摄像头自己压缩, 不用 CPU 再去转 YUYV
+cap = cv2.VideoCapture(0, cv2.CAP_V4L2)
+if not cap.isOpened():
+    cap = cv2.VideoCapture(0)  # 非 Linux 平台兜底
+cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG'))
+cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
+cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
+# V4L2 默认缓冲 4 帧, 每次 read() 都是几百毫秒前的旧帧, 把缓冲压到 1 帧
+cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+cap.set(cv2.CAP_PROP_FPS, 30)
+
+
+def read_latest(cap):
+    # 有的后端不认 BUFFERSIZE, 兜底: 限时把积压的帧先排空再取
+    deadline = time.monotonic() + 0.001
+    while cap.grab() and time.monotonic() < deadline:
+        pass
+    return cap.retrieve()
+
 
 if not cap.isOpened():
     print("Error: Can't open the camera.")
     exit()
 
+# 分类抖一下就切歌太吵, 连续 5 帧都是同一情绪才真的切
+EMOTION_STABLE_FRAMES = 5
+recent_emotions = collections.deque(maxlen=EMOTION_STABLE_FRAMES)
+
 while True:
-    ret, frame = cap.read()
+    ret, frame = read_latest(cap)
 
     if not ret:
         print("Error: Can't read the video frame.")
         break
 
     faces = emotion_detector.detect_emotions(frame)
-    for face in faces:
-        box = face['box']
-        emotion = face['emotions']
-
-        # 画框（原封不动）
-        cv2.rectangle(frame,
-                      (box[0], box[1]),
-                      (box[0]+box[2], box[1]+box[3]),
-                      (0, 255, 0), 2)
-
-        # 找最大情绪（保留你们原来的写法）
-        max_emotion = {'none': 0}
-        for key in emotion:
-            if emotion.get(key) > next(iter(max_emotion.values())):
-                max_emotion.clear()
-                max_emotion[key] = emotion.get(key)
-
-        # 得到当前最大情绪
-        current_emotion = next(iter(max_emotion.keys()))
-
-        # 显示在画面上
-        cv2.putText(frame, current_emotion,
-                    (box[0], box[1]+box[3]+10),
-                    cv2.FONT_HERSHEY_COMPLEX,
-                    0.4, (255, 255, 255), 1)
-
-        # =======================
-        # 新增：根据情绪播放音乐
-        # =======================
-        play_music_for_emotion(current_emotion)
+    if faces:
+        # 所有框拼成一个数组, polylines 一次画完, 不在 Python 里逐个 rectangle
+        boxes = np.array([f['box'] for f in faces], np.int32)
+        corners = np.stack([
+            boxes[:, :2],
+            np.column_stack([boxes[:, 0] + boxes[:, 2], boxes[:, 1]]),
+            boxes[:, :2] + boxes[:, 2:],
+            np.column_stack([boxes[:, 0], boxes[:, 1] + boxes[:, 3]]),
+        ], axis=1)
+        cv2.polylines(frame, corners, True, (0, 255, 0), 2)
+
+        # 所有脸的 7 个分数拼成矩阵, argmax 一次算完
+        emotion_keys = list(faces[0]['emotions'].keys())
+        scores = np.array([list(f['emotions'].values()) for f in faces])
+        top = scores.argmax(axis=1)
+        for (x, y, w, h), idx in zip(boxes.tolist(), top):
+            cv2.putText(frame, emotion_keys[idx],
+                        (x, y+h+10),
+                        cv2.FONT_HERSHEY_COMPLEX,
+                        0.4, (255, 255, 255), 1)
+
+        # 第一张脸的情绪当作当前情绪
+        current_emotion = emotion_keys[top[0]]
+
+    # =======================
+    # 根据情绪播放音乐(带防抖)
+    # =======================
+    if faces:
+        recent_emotions.append(current_emotion)
+        if (len(recent_emotions) == recent_emotions.maxlen
+                and all(e == current_emotion for e in recent_emotions)):
+            request_music(current_emotion)
 
     cv2.imshow('My Camera', frame)
 
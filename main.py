@@ -1,38 +1,262 @@
+import collections
+import os
+import threading
+import time
+
+# TF 和 OpenCV 各自按核数开线程池, 叠一起互相抢核, 在 import 前就限住
+os.environ.setdefault('OMP_NUM_THREADS', '2')
+os.environ.setdefault('TF_NUM_INTRAOP_THREADS', '2')
+os.environ.setdefault('TF_NUM_INTEROP_THREADS', '1')
+
 import cv2
+import numpy as np
 from fer.fer import FER
 
-emotion_detector = FER()
+cv2.setNumThreads(1)
+
+# 顺序和 fer 内部 EMOTIONS 一致
+EMOTION_LABELS = ['angry', 'disgust', 'fear', 'happy', 'sad', 'surprise', 'neutral']
+
+# export_emotion_tflite.py 生成的量化模型, 存在就优先用
+TFLITE_PATH = 'emotion_int8.tflite'
+
+CAMERA_WIDTH = 640
+CAMERA_HEIGHT = 480
+
+
+def open_camera():
+    # 明确走 V4L2 并要 MJPG: 摄像头自己压缩, 不用 CPU 再去转 YUYV
+    cap = cv2.VideoCapture(0, cv2.CAP_V4L2)
+    if not cap.isOpened():
+        cap = cv2.VideoCapture(0)  # 非 Linux 平台兜底
+    cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG'))
+    cap.set(cv2.CAP_PROP_FRAME_WIDTH, CAMERA_WIDTH)
+    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, CAMERA_HEIGHT)
+    # V4L2 默认缓冲 4 帧, 每次 read() 都是几百毫秒前的旧帧, 把缓冲压到 1 帧
+    cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+    cap.set(cv2.CAP_PROP_FPS, 30)
+    return cap
+
+
+class EmotionProcessor:
+    # 模型只在构造时加载一次, 主循环反复用同一个句柄, 不要每帧重建
+
+    # 16x16 BGR 缩略图的 L1 距离, 平均每通道差 3 以内当作同一画面
+    SIG_DIFF_SKIP = 2304
+
+    # 情绪历史窗口长度(帧)
+    HISTORY_MAX_LEN = 20
+
+    # 人脸 dHash -> 情绪 的缓存上限
+    FACE_CACHE_MAX = 128
+
+    def __init__(self):
+        # mtcnn 在 CPU 上太慢, 明确用 OpenCV 级联检测, 640x480 够用了
+        # use_tflite=False: fer 默认走 TFLite 分支, 那边根本不会创建 Keras 分类器
+        self.detector = FER(mtcnn=False, use_tflite=False)
+        # fer 没把分类器公开出来, 直接拿私有成员, 好把一帧里的人脸整批送进去
+        self.classifier = self.detector._FER__emotion_classifier
+        self.target_size = self.detector._FER__emotion_target_size
+        # 有量化模型就走 TFLite, int8 权重在 CPU 上省好几倍带宽和算力
+        self.interpreter = None
+        if os.path.exists(TFLITE_PATH):
+            import tensorflow as tf
+            self.interpreter = tf.lite.Interpreter(model_path=TFLITE_PATH, num_threads=2)
+            self.interpreter.allocate_tensors()
+            self._in_idx = self.interpreter.get_input_details()[0]['index']
+            self._out_idx = self.interpreter.get_output_details()[0]['index']
+            self._tflite_batch_shape = None
+            print(f"[INFO] Using quantized model {TFLITE_PATH}")
+        self._last_sig = None
+        self._last_results = []
+        # deque 两头进出都是 O(1), 计数随进出增减, 不用每帧扫整个窗口
+        self.emotion_history = collections.deque(maxlen=self.HISTORY_MAX_LEN)
+        self._recent_counts = collections.Counter()
+        # 同一张脸几百毫秒内情绪基本不变, 按感知哈希缓存结果, 命中就不跑模型
+        self._face_cache = collections.OrderedDict()
+
+    def detect_emotion(self, frame):
+        # 返回 [(box, 情绪名, 分数), ...]
+        # 人坐着不动时帧与帧几乎一样, 画面没变就复用上次结果, 检测和推理全省掉
+        sig = cv2.resize(frame, (16, 16), interpolation=cv2.INTER_AREA)
+        if self._last_sig is None or cv2.norm(sig, self._last_sig, cv2.NORM_L1) >= self.SIG_DIFF_SKIP:
+            self._last_sig = sig
+            self._last_results = self._analyze(frame)
+        if self._last_results:
+            # 按最大的那张脸记历史
+            main_face = max(self._last_results, key=lambda r: r[0][2] * r[0][3])
+            self._update_history(main_face[1])
+        return self._last_results
+
+    def _predict(self, batch):
+        if self.interpreter is None:
+            return self.classifier.predict(batch, verbose=0)
+        # 批大小和上次不一样才重调形状, 单人场景就不用每次重新分配张量
+        if batch.shape != self._tflite_batch_shape:
+            self.interpreter.resize_tensor_input(self._in_idx, batch.shape)
+            self.interpreter.allocate_tensors()
+            self._tflite_batch_shape = batch.shape
+        self.interpreter.set_tensor(self._in_idx, batch)
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self._out_idx)
+
+    def _update_history(self, emotion):
+        if len(self.emotion_history) == self.emotion_history.maxlen:
+            old = self.emotion_history[0]
+            self._recent_counts[old] -= 1
+            if not self._recent_counts[old]:
+                del self._recent_counts[old]
+        self.emotion_history.append(emotion)
+        self._recent_counts[emotion] += 1
+
+    def stable_emotion(self):
+        # 窗口里出现最多的情绪, 只扫计数表, 不扫历史本身
+        if not self._recent_counts:
+            return None
+        return max(self._recent_counts, key=self._recent_counts.get)
+
+    @staticmethod
+    def _dhash(gray_face):
+        # 9x8 缩略图比较相邻像素, 64 位指纹, 对轻微晃动/光照不敏感
+        small = cv2.resize(gray_face, (9, 8), interpolation=cv2.INTER_AREA)
+        return np.packbits(small[:, 1:] > small[:, :-1]).tobytes()
+
+    def _analyze(self, frame):
+        boxes = self.detector.find_faces(frame, bgr=True)
+        if len(boxes) == 0:
+            return []
+        entries = []  # (box, 指纹, 缓存命中的结果或 None)
+        crops = []
+        for (x, y, w, h) in boxes:
+            face = frame[max(y, 0):y + h, max(x, 0):x + w]
+            if face.size == 0:
+                continue
+            # 只把脸那一小块转灰度, 整帧 cvtColor 是白搬 900KB
+            face = cv2.cvtColor(face, cv2.COLOR_BGR2GRAY)
+            key = self._dhash(face)
+            cached = self._face_cache.get(key)
+            if cached is not None:
+                self._face_cache.move_to_end(key)
+                entries.append(((x, y, w, h), key, cached))
+                continue
+            face = cv2.resize(face, self.target_size).astype('float32')
+            crops.append((face / 255.0 - 0.5) * 2.0)  # 跟 fer 自己的预处理一样
+            entries.append(((x, y, w, h), key, None))
+        if crops:
+            # 没命中缓存的脸一次前向算完, 不要一张一张喂
+            preds = iter(self._predict(np.expand_dims(np.stack(crops), -1)))
+        results = []
+        for box, key, cached in entries:
+            if cached is None:
+                scores = next(preds)
+                i = int(scores.argmax())
+                cached = (EMOTION_LABELS[i], float(scores[i]))
+                self._face_cache[key] = cached
+                if len(self._face_cache) > self.FACE_CACHE_MAX:
+                    self._face_cache.popitem(last=False)
+            results.append((box, cached[0], cached[1]))
+        return results
+
+
+class FrameGrabber(threading.Thread):
+    # 后台线程不停抓帧, 只留最新一帧, 推理再慢画面也不会越落越远
+
+    def __init__(self, cap):
+        super().__init__(daemon=True)
+        self.cap = cap
+        self.lock = threading.Lock()
+        self.stop_evt = threading.Event()
+        self.new_frame_evt = threading.Event()
+        self.frame = None
+
+    def run(self):
+        while not self.stop_evt.is_set():
+            if not self.cap.grab():
+                break
+            ret, frame = self.cap.retrieve()
+            if not ret:
+                continue
+            with self.lock:
+                self.frame = frame
+            self.new_frame_evt.set()
+
+    def latest(self):
+        with self.lock:
+            return self.frame
+
+
+def main():
+    emotion_processor = EmotionProcessor()
+
+    cap = open_camera()
+
+    if not cap.isOpened():
+        print("Error: Can't open the camera.")
+        return
+
+    grabber = FrameGrabber(cap)
+    grabber.start()
+
+    # imshow + waitKey(1) 一次要吃掉好几毫秒, 放到单独线程里, 推理循环不等 GUI
+    quit_evt = threading.Event()
+    disp_lock = threading.Lock()
+    disp_slot = [None]
+
+    def show_loop():
+        while not quit_evt.is_set():
+            with disp_lock:
+                shown = disp_slot[0]
+            if shown is not None:
+                cv2.imshow('Emotion Sensing Light', shown)
+            if cv2.waitKey(1) & 0xFF == ord('q'):
+                quit_evt.set()
+        cv2.destroyAllWindows()
+
+    show_thread = threading.Thread(target=show_loop, daemon=True)
+    show_thread.start()
+
+    # 最近 30 帧的时间戳, FPS = 帧数 / 首尾时间差
+    frame_ts = collections.deque(maxlen=30)
+
+    while not quit_evt.is_set():
+        # 没新帧就睡到抓帧线程叫醒为止; 超时说明帧还没来, 别把同一帧重画一遍
+        if not grabber.new_frame_evt.wait(timeout=0.033):
+            if not grabber.is_alive():
+                print("Error: Can't read the video frame.")
+                break
+            continue
+        grabber.new_frame_evt.clear()
+        frame = grabber.latest()
 
-cap = cv2.VideoCapture(0);
+        if frame is None:
+            continue
 
-if not cap.isOpened():
-    print("Error: Can't open the camera.")
-    exit()
+        # 表情分类只要 48x48 的脸, 半分辨率送去分析就够, 检测和拷贝都省一半多
+        small = cv2.resize(frame, None, fx=0.5, fy=0.5, interpolation=cv2.INTER_AREA)
+        for box, emotion, score in emotion_processor.detect_emotion(small):
+            # 坐标是半分辨率下的, 画回原图要乘 2
+            x, y, w, h = box[0] * 2, box[1] * 2, box[2] * 2, box[3] * 2
+            cv2.rectangle(frame, (x, y), (x + w, y + h), (0, 255, 0), 2)
+            cv2.putText(frame, emotion, (x, y + h + 10), cv2.FONT_HERSHEY_COMPLEX, 0.4, (255, 255, 255), 1)
 
-while True:
-    ret, frame = cap.read()
+        mood = emotion_processor.stable_emotion()
+        if mood:
+            cv2.putText(frame, f"mood: {mood}", (10, 20), cv2.FONT_HERSHEY_COMPLEX, 0.5, (255, 255, 255), 1)
 
-    if not ret:
-        print("Error: Can't read the video frame.")
-        break
+        frame_ts.append(time.monotonic())
+        if len(frame_ts) > 1:
+            fps = (len(frame_ts) - 1) / (frame_ts[-1] - frame_ts[0])
+            cv2.putText(frame, f"FPS: {fps:.0f}", (10, 40), cv2.FONT_HERSHEY_COMPLEX, 0.5, (255, 255, 255), 1)
 
-    faces = emotion_detector.detect_emotions(frame)
-    for face in faces:
-        box = face['box']
-        emotion = face['emotions']
-        cv2.rectangle(frame, (box[0], box[1]), (box[0]+box[2], box[1]+box[3]), (0, 255, 0), 2)
-        max_emotion = {'none': 0} 
-        for key in emotion:
-            if emotion.get(key) > next(iter(max_emotion.values())):
-                max_emotion.clear()
-                max_emotion[key] = emotion.get(key)
-        cv2.putText(frame, next(iter(max_emotion.keys())), (box[0], box[1]+box[3]+10), cv2.FONT_HERSHEY_COMPLEX, 0.4, (255, 255, 255), 1)
+        # 画完直接把这一帧交给窗口线程, 不拷贝; 抓帧线程每次给的都是新数组
+        with disp_lock:
+            disp_slot[0] = frame
 
-    cv2.imshow('My Camera', frame)
+    print("The program is closing...")
+    quit_evt.set()
+    grabber.stop_evt.set()
+    show_thread.join(timeout=1)
+    cap.release()
 
-    if cv2.waitKey(1) & 0xFF == ord('q'):
-        break
 
-print("The program is closing...")
-cap.release()
-cv2.destroyAllWindows()
+main()